@@ -10,46 +10,152 @@ Flow:
 7. Client receives tokens and can use enabled tools
 """
 
+import asyncio
+import base64
+import html
 import os
-import secrets
 import signal
 import sys
 import threading
 import logging
 import time
-from typing import Any, Optional
-from urllib.parse import urlencode
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, Optional, Protocol
+from urllib.parse import quote, urlencode
 
+import httpx
+import orjson
 from dotenv import load_dotenv
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.templating import Jinja2Templates
 from fastapi.responses import RedirectResponse, HTMLResponse
 from starlette.middleware.sessions import SessionMiddleware
+from redis.asyncio import Redis
 
 from fastmcp import FastMCP
+from fastmcp.server.auth.oauth_proxy import ClientCode
 from fastmcp.server.auth.providers.google import GoogleProvider
 from fastmcp.server.dependencies import get_access_token
 
 # Load environment variables
 load_dotenv()
 
+# Handlers/format are configured in main(); the logger itself is shared module-wide
+logger = logging.getLogger("server")
+
 # Configuration
 BASE_URL = os.getenv("BASE_URL", "http://localhost:8000")
 GOOGLE_CLIENT_ID = os.getenv("GOOGLE_OAUTH_CLIENT_ID")
 GOOGLE_CLIENT_SECRET = os.getenv("GOOGLE_OAUTH_CLIENT_SECRET")
 SESSION_SECRET = os.getenv("SESSION_SECRET", "dev-super-secret-change-me-in-production")
 PORT = int(os.getenv("PORT", 8000))
+REDIS_URL = os.getenv("REDIS_URL")
+
+# Store TTLs (seconds)
+TX_TTL = 5 * 60  # pending OAuth transactions
+CODE_TTL = 5 * 60  # client authorization codes
+PREFS_TTL = 30 * 24 * 60 * 60  # user tool preferences
+PREFS_CACHE_TTL = 30  # per-process cache of enabled tools
+SWEEP_INTERVAL = 30  # in-memory expiry sweep
 
 # Validate required env vars
 if not GOOGLE_CLIENT_ID or not GOOGLE_CLIENT_SECRET:
     raise ValueError("GOOGLE_OAUTH_CLIENT_ID and GOOGLE_OAUTH_CLIENT_SECRET must be set in .env")
 
-# In-memory stores (use Redis/DB in production)
-tx_store: dict[str, dict[str, Any]] = {}
-prefs_store: dict[str, dict[str, Any]] = {}
 
-# Setup templates
-templates = Jinja2Templates(directory="templates")
+# ============================================================================
+# Key-value stores (Redis when REDIS_URL is set, in-memory otherwise)
+# ============================================================================
+
+class Store(Protocol):
+    """Minimal async key-value interface for JSON-serializable dicts."""
+
+    async def get(self, key: str) -> Optional[dict[str, Any]]: ...
+
+    async def set(self, key: str, value: dict[str, Any], ex: Optional[int] = None) -> None: ...
+
+    async def delete(self, key: str) -> None: ...
+
+
+class RedisStore:
+    """Store backed by Redis. Values are JSON-encoded (orjson); `ex` maps to SETEX."""
+
+    def __init__(self, client: Redis):
+        self._redis = client
+
+    async def get(self, key: str) -> Optional[dict[str, Any]]:
+        raw = await self._redis.get(key)
+        return orjson.loads(raw) if raw is not None else None
+
+    async def set(self, key: str, value: dict[str, Any], ex: Optional[int] = None) -> None:
+        await self._redis.set(key, orjson.dumps(value), ex=ex)
+
+    async def delete(self, key: str) -> None:
+        await self._redis.delete(key)
+
+
+class TTLStore:
+    """Process-local LRU store for development.
+
+    Entries expire `ttl` seconds after being set (or `ex` when given) and the
+    least recently used entry is evicted once `max_entries` is exceeded, so
+    abandoned OAuth flows cannot grow memory without bound.
+    """
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._data: OrderedDict[str, tuple[dict[str, Any], float]] = OrderedDict()
+
+    async def get(self, key: str) -> Optional[dict[str, Any]]:
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: dict[str, Any], ex: Optional[int] = None) -> None:
+        self._data[key] = (value, time.monotonic() + (ex if ex is not None else self.ttl))
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    async def delete(self, key: str) -> None:
+        self._data.pop(key, None)
+
+    def purge_expired(self) -> int:
+        """Drop all expired entries and return how many were removed."""
+        now = time.monotonic()
+        expired = [key for key, (_, expires_at) in self._data.items() if expires_at <= now]
+        for key in expired:
+            del self._data[key]
+        return len(expired)
+
+
+if REDIS_URL:
+    redis_client: Optional[Redis] = Redis.from_url(REDIS_URL)
+    tx_store: Store = RedisStore(redis_client)
+    prefs_store: Store = RedisStore(redis_client)
+else:
+    redis_client = None
+    tx_store = TTLStore(ttl=TX_TTL, max_entries=10_000)
+    prefs_store = TTLStore(ttl=PREFS_TTL, max_entries=100_000)
+
+# Setup templates: compiled once at import (with an on-disk bytecode cache
+# across restarts) so requests only pay for rendering
+templates = Environment(
+    loader=FileSystemLoader("templates"),
+    bytecode_cache=FileSystemBytecodeCache(),
+    autoescape=True,
+    auto_reload=False,
+    cache_size=400,
+)
+preferences_template = templates.get_template("preferences.html")
 
 
 # ============================================================================
@@ -71,13 +177,133 @@ def cleanup_resources():
         # TODO: close DB pools, stop background threads, flush telemetry, etc.
         pass
     except Exception as exc:
-        logging.getLogger("server").exception("Error during cleanup: %s", exc)
+        logger.exception("Error during cleanup: %s", exc)
+
+
+# ============================================================================
+# Token generation
+# ============================================================================
+
+_TOKEN_POOL_REFILL = 4096
+_token_pool = bytearray()
+_token_pool_lock = threading.Lock()
+
+# A forked child must never hand out bytes its parent already holds
+os.register_at_fork(after_in_child=_token_pool.clear)
+
+
+def fast_token_urlsafe(nbytes: int = 32) -> str:
+    """Like secrets.token_urlsafe, but drawing from a buffer of os.urandom bytes.
+
+    The buffer is refilled in large chunks so most tokens cost no syscall.
+    """
+    with _token_pool_lock:
+        if len(_token_pool) < nbytes:
+            _token_pool.extend(os.urandom(max(_TOKEN_POOL_REFILL, nbytes)))
+        out = bytes(_token_pool[:nbytes])
+        del _token_pool[:nbytes]
+    return base64.urlsafe_b64encode(out).rstrip(b"=").decode("ascii")
+
+
+# ============================================================================
+# Shared upstream HTTP client
+# ============================================================================
+
+_http_client: Optional[httpx.AsyncClient] = None
+_http_client_lock = asyncio.Lock()
+
+
+async def get_http_client() -> httpx.AsyncClient:
+    """Return the process-wide HTTP client, creating it on first use.
+
+    Reusing one client keeps connections to Google's token endpoint pooled
+    instead of paying a TLS handshake on every callback. It carries no
+    credentials or tokens; those are passed per request.
+    """
+    global _http_client
+    if _http_client is None:
+        async with _http_client_lock:
+            if _http_client is None:
+                _http_client = httpx.AsyncClient(timeout=httpx.Timeout(30.0, connect=10.0))
+    return _http_client
+
+
+async def close_http_client():
+    """Close the shared HTTP client, if it was created."""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+async def exchange_code(
+    provider: GoogleProvider,
+    code: str,
+    redirect_uri: str,
+    code_verifier: Optional[str] = None,
+) -> dict[str, Any]:
+    """Exchange an authorization code at the upstream token endpoint.
+
+    Client authentication is sent with this request only, so no per-user
+    tokens are retained on the shared client.
+    """
+    data = {
+        "grant_type": "authorization_code",
+        "code": code,
+        "redirect_uri": redirect_uri,
+    }
+    if code_verifier:
+        data["code_verifier"] = code_verifier
+
+    client_id = provider._upstream_client_id
+    client_secret = provider._upstream_client_secret.get_secret_value()
+    auth = None
+    if provider._token_endpoint_auth_method == "client_secret_post":
+        data["client_id"] = client_id
+        data["client_secret"] = client_secret
+    else:
+        # client_secret_basic: credentials are form-encoded before base64 (RFC 6749 2.3.1)
+        auth = httpx.BasicAuth(quote(client_id, safe=""), quote(client_secret, safe=""))
+
+    client = await get_http_client()
+    response = await client.post(
+        provider._upstream_token_endpoint,
+        data=data,
+        auth=auth,
+        headers={"Accept": "application/json"},
+    )
+    response.raise_for_status()
+    return response.json()
 
 
 # ============================================================================
 # Custom GoogleProvider that intercepts callback for preferences
 # ============================================================================
 
+def _decode_id_token_payload(token: str) -> dict[str, Any]:
+    """Decode the claims of a JWT without verifying its signature.
+
+    Only used for the ID token we just received from Google's token endpoint
+    over TLS, so the signature check is skipped.
+    """
+    _, payload, _ = token.split(".")
+    return orjson.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+
+
+_ERR_MISSING_CALLBACK_PARAMS = (
+    b"<h1>OAuth Error</h1><p>Missing authorization code or transaction ID</p>"
+)
+_ERR_INVALID_TRANSACTION = b"<h1>OAuth Error</h1><p>Invalid or expired transaction</p>"
+
+
+def _oauth_error(detail: str, status_code: int) -> HTMLResponse:
+    """Build an error page for messages that vary per request (escaped)."""
+    return HTMLResponse(
+        f"<h1>OAuth Error</h1><p>{html.escape(detail)}</p>",
+        status_code=status_code,
+    )
+
+
 class PreferencesGoogleProvider(GoogleProvider):
     """
     Subclass GoogleProvider to intercept the OAuth callback and redirect to
@@ -90,91 +316,72 @@ class PreferencesGoogleProvider(GoogleProvider):
         """
         try:
             # Extract callback parameters
-            idp_code = request.query_params.get("code")
-            txn_id = request.query_params.get("state")
-            error = request.query_params.get("error")
+            params = request.query_params
+            idp_code = params.get("code")
+            txn_id = params.get("state")
+            error = params.get("error")
 
             # Handle errors from Google
             if error:
-                error_description = request.query_params.get("error_description")
-                return HTMLResponse(
-                    f"<h1>OAuth Error</h1><p>{error}: {error_description}</p>",
-                    status_code=400,
-                )
+                return _oauth_error(f"{error}: {params.get('error_description')}", 400)
 
-            if not idp_code or not txn_id:
-                return HTMLResponse(
-                    "<h1>OAuth Error</h1><p>Missing authorization code or transaction ID</p>",
-                    status_code=400,
-                )
+            if not (idp_code and txn_id):
+                return HTMLResponse(_ERR_MISSING_CALLBACK_PARAMS, status_code=400)
 
             # Look up transaction data (stored by parent's authorize() method)
             transaction_model = await self._transaction_store.get(key=txn_id)
             if not transaction_model:
-                return HTMLResponse(
-                    "<h1>OAuth Error</h1><p>Invalid or expired transaction</p>",
-                    status_code=400,
-                )
-            transaction = transaction_model.model_dump()
+                return HTMLResponse(_ERR_INVALID_TRANSACTION, status_code=400)
 
             # Exchange authorization code for tokens (server-side)
-            from authlib.integrations.httpx_client import AsyncOAuth2Client
-
-            oauth_client = AsyncOAuth2Client(
-                client_id=self._upstream_client_id,
-                client_secret=self._upstream_client_secret.get_secret_value(),
-                token_endpoint_auth_method=self._token_endpoint_auth_method,
-                timeout=30,
-            )
-
             try:
                 idp_redirect_uri = f"{str(self.base_url).rstrip('/')}{self._redirect_path}"
-                token_params = {
-                    "url": self._upstream_token_endpoint,
-                    "code": idp_code,
-                    "redirect_uri": idp_redirect_uri,
-                }
 
                 # Include PKCE if forwarding is enabled
-                proxy_code_verifier = transaction.get("proxy_code_verifier")
-                if proxy_code_verifier:
-                    token_params["code_verifier"] = proxy_code_verifier
-
-                idp_tokens: dict[str, Any] = await oauth_client.fetch_token(**token_params)
+                idp_tokens = await exchange_code(
+                    self,
+                    idp_code,
+                    idp_redirect_uri,
+                    code_verifier=transaction_model.proxy_code_verifier,
+                )
 
             except Exception as e:
-                return HTMLResponse(
-                    f"<h1>OAuth Error</h1><p>Token exchange failed: {e}</p>",
-                    status_code=500,
-                )
+                return _oauth_error(f"Token exchange failed: {e}", 500)
 
             # Get user claims from ID token (Google returns these)
-            import jwt as pyjwt
-
             id_token = idp_tokens.get("id_token")
             claims = {}
             if id_token:
                 try:
-                    claims = pyjwt.decode(id_token, options={"verify_signature": False})
+                    claims = _decode_id_token_payload(id_token)
                 except Exception:
                     pass
 
-            # Store transaction and tokens for preference page
-            tx_store[txn_id] = {
-                "transaction": transaction,
-                "idp_tokens": idp_tokens,
-                "claims": claims,
-                "created_at": time.time(),
-            }
+            # Store only the transaction fields needed to finish the flow,
+            # plus tokens and claims for the preference page
+            await tx_store.set(
+                f"oauth_tx:{txn_id}",
+                {
+                    "client_id": transaction_model.client_id,
+                    "client_redirect_uri": transaction_model.client_redirect_uri,
+                    "client_state": transaction_model.client_state,
+                    "code_challenge": transaction_model.code_challenge,
+                    "code_challenge_method": transaction_model.code_challenge_method,
+                    "scopes": transaction_model.scopes,
+                    "idp_tokens": idp_tokens,
+                    "claims": claims,
+                },
+                ex=TX_TTL,
+            )
+
+            # Only the opaque txn_id goes in the session cookie; the payload stays server-side
+            request.session["txn_id"] = txn_id
 
             # Redirect to preferences page instead of completing OAuth immediately
             return RedirectResponse(url=f"/preferences?txn_id={txn_id}", status_code=302)
 
         except Exception as e:
-            return HTMLResponse(
-                f"<h1>OAuth Error</h1><p>Internal server error: {e}</p>",
-                status_code=500,
-            )
+            return _oauth_error(f"Internal server error: {e}", 500)
 
 
 # ============================================================================
@@ -200,16 +407,30 @@ mcp = FastMCP(name="Google OAuth MCP with Preferences", auth=auth_provider)
 # MCP Tools (with preference enforcement)
 # ============================================================================
 
-def get_user_preferences(sub: str) -> set[str]:
+# Tools that can be toggled on the preferences page (form field name == tool name)
+_TOOLS = frozenset({"get_email", "get_name"})
+
+
+# Enabled tools per sub, checked on every tool call. Invalidated locally when
+# preferences are saved; the short TTL bounds staleness across workers.
+_prefs_cache = TTLStore(ttl=PREFS_CACHE_TTL, max_entries=1024)
+
+
+async def get_user_preferences(sub: str) -> frozenset[str]:
     """Get enabled tools for a user."""
-    return prefs_store.get(sub, {}).get("enabled_tools", set())
+    cached = await _prefs_cache.get(sub)
+    if cached is None:
+        prefs = await prefs_store.get(f"prefs:{sub}") or {}
+        cached = {"enabled_tools": frozenset(prefs.get("enabled_tools", ()))}
+        await _prefs_cache.set(sub, cached)
+    return cached["enabled_tools"]
 
 
-def require_tool_enabled(tool_name: str):
+async def require_tool_enabled(tool_name: str):
     """Enforce that a tool is enabled for the current user."""
     token = get_access_token()
     sub = token.claims.get("sub")
-    enabled_tools = get_user_preferences(sub)
+    enabled_tools = await get_user_preferences(sub) if sub else frozenset()
     
     if tool_name not in enabled_tools:
         raise HTTPException(
@@ -224,7 +445,7 @@ async def get_email() -> str:
     
     This tool must be enabled in user preferences.
     """
-    require_tool_enabled("get_email")
+    await require_tool_enabled("get_email")
     token = get_access_token()
     return token.claims.get("email", "")
 
@@ -235,7 +456,7 @@ async def get_name() -> str:
     
     This tool must be enabled in user preferences.
     """
-    require_tool_enabled("get_name")
+    await require_tool_enabled("get_name")
     token = get_access_token()
     return token.claims.get("name", "")
 
@@ -248,35 +469,28 @@ async def get_name() -> str:
 # Preferences Routes (define FIRST before creating app)
 # ============================================================================
 
+_ERR_MISSING_TXN_PARAM = b"<h1>Error</h1><p>Missing txn_id parameter.</p>"
+_ERR_MISSING_TXN_FIELD = b"<h1>Error</h1><p>Missing transaction ID.</p>"
+_ERR_EXPIRED_TXN = b"<h1>Error</h1><p>Invalid or expired transaction. Please try again.</p>"
+_ERR_SAVE_FAILED = b"<h1>Error</h1><p>Could not save your preferences. Please try again.</p>"
+
+
 async def get_preferences(request: Request):
     """Display the preferences page after OAuth callback."""
-    txn_id = request.query_params.get("txn_id")
+    txn_id = request.query_params.get("txn_id") or request.session.get("txn_id")
     if not txn_id:
-        return HTMLResponse(
-            "<h1>Error</h1><p>Missing txn_id parameter.</p>",
-            status_code=400,
-        )
+        return HTMLResponse(_ERR_MISSING_TXN_PARAM, status_code=400)
     
     # Validate transaction exists
-    if txn_id not in tx_store:
-        return HTMLResponse(
-            "<h1>Error</h1><p>Invalid or expired transaction. Please try again.</p>",
-            status_code=400,
-        )
+    tx_data = await tx_store.get(f"oauth_tx:{txn_id}")
+    if tx_data is None:
+        return HTMLResponse(_ERR_EXPIRED_TXN, status_code=400)
     
-    tx_data = tx_store[txn_id]
     claims = tx_data.get("claims", {})
     email = claims.get("email", "user")
     
     # Render preferences template
-    return templates.TemplateResponse(
-        "preferences.html",
-        {
-            "request": request,
-            "txn_id": txn_id,
-            "email": email,
-        },
-    )
+    return HTMLResponse(preferences_template.render(txn_id=txn_id, email=email))
 
 
 async def post_preferences(request: Request):
@@ -287,66 +501,75 @@ async def post_preferences(request: Request):
     txn_id = form.get("txn_id")
     
     if not txn_id:
-        return HTMLResponse(
-            "<h1>Error</h1><p>Missing transaction ID.</p>",
-            status_code=400,
-        )
+        return HTMLResponse(_ERR_MISSING_TXN_FIELD, status_code=400)
     
     # Validate transaction
-    if txn_id not in tx_store:
-        return HTMLResponse(
-            "<h1>Error</h1><p>Invalid or expired transaction. Please try again.</p>",
-            status_code=400,
-        )
+    tx_data = await tx_store.get(f"oauth_tx:{txn_id}")
+    if tx_data is None:
+        return HTMLResponse(_ERR_EXPIRED_TXN, status_code=400)
     
-    tx_data = tx_store[txn_id]
-    transaction = tx_data["transaction"]
     idp_tokens = tx_data["idp_tokens"]
     claims = tx_data.get("claims", {})
     
     # Get selected tools from form
-    selected_tools = set()
-    if form.get("get_email"):
-        selected_tools.add("get_email")
-    if form.get("get_name"):
-        selected_tools.add("get_name")
-    
-    # Store preferences by user subject
-    user_sub = claims.get("sub")
-    if user_sub:
-        prefs_store[user_sub] = {"enabled_tools": selected_tools}
+    selected_tools = {tool for tool in _TOOLS if form.get(tool)}
     
     # Now complete the OAuth flow manually (same logic as parent's _handle_idp_callback)
-    client_code = secrets.token_urlsafe(32)
-    code_expires_at = int(time.time() + 5 * 60)  # 5 minutes
-    
-    # Import the ClientCode model from fastmcp
-    from fastmcp.server.auth.oauth_proxy import ClientCode
+    client_code = fast_token_urlsafe(32)
+    now = time.time()
+    code_expires_at = int(now) + CODE_TTL
     
-    # Store client code with PKCE challenge and IdP tokens
-    await auth_provider._code_store.put(
-        key=client_code,
-        value=ClientCode(
-            code=client_code,
-            client_id=transaction["client_id"],
-            redirect_uri=transaction["client_redirect_uri"],
-            code_challenge=transaction["code_challenge"],
-            code_challenge_method=transaction["code_challenge_method"],
-            scopes=transaction["scopes"],
-            idp_tokens=idp_tokens,
-            expires_at=code_expires_at,
-            created_at=time.time(),
+    # Store client code (with PKCE challenge and IdP tokens) and save
+    # preferences by user subject concurrently. Both must succeed before the
+    # transaction is cleaned up, so a failure here can be retried.
+    writes = [
+        auth_provider._code_store.put(
+            key=client_code,
+            value=ClientCode(
+                code=client_code,
+                client_id=tx_data["client_id"],
+                redirect_uri=tx_data["client_redirect_uri"],
+                code_challenge=tx_data["code_challenge"],
+                code_challenge_method=tx_data["code_challenge_method"],
+                scopes=tx_data["scopes"],
+                idp_tokens=idp_tokens,
+                expires_at=code_expires_at,
+                created_at=now,
+            ),
+            ttl=CODE_TTL,
         ),
-        ttl=5 * 60,
-    )
+    ]
+    user_sub = claims.get("sub")
+    if user_sub:
+        writes.append(
+            prefs_store.set(
+                f"prefs:{user_sub}",
+                {"enabled_tools": sorted(selected_tools)},
+                ex=PREFS_TTL,
+            )
+        )
+    try:
+        await asyncio.gather(*writes)
+    except Exception:
+        logger.exception("Saving preferences failed for txn %s", txn_id)
+        return HTMLResponse(_ERR_SAVE_FAILED, status_code=500)
+    if user_sub:
+        await _prefs_cache.delete(user_sub)
     
-    # Clean up transaction
-    await auth_provider._transaction_store.delete(key=txn_id)
-    tx_store.pop(txn_id, None)
+    # Clean up the transaction. This is best-effort: both entries expire on
+    # their own, so a failure is logged but does not abort the redirect.
+    for result in await asyncio.gather(
+        auth_provider._transaction_store.delete(key=txn_id),
+        tx_store.delete(f"oauth_tx:{txn_id}"),
+        return_exceptions=True,
+    ):
+        if isinstance(result, Exception):
+            logger.error("Transaction cleanup failed for txn %s: %r", txn_id, result)
+    request.session.pop("txn_id", None)
     
     # Build client callback URL with authorization code and original state
-    client_redirect_uri = transaction["client_redirect_uri"]
-    client_state = transaction["client_state"]
+    client_redirect_uri = tx_data["client_redirect_uri"]
+    client_state = tx_data["client_state"]
     
     callback_params = {
         "code": client_code,
@@ -366,9 +589,7 @@ async def post_preferences(request: Request):
 # Home page
 # ============================================================================
 
-async def home():
-    """Home page with instructions."""
-    return HTMLResponse(f"""
+_HOME_HTML = (f"""
     <!DOCTYPE html>
     <html lang="en">
     <head>
@@ -438,7 +659,71 @@ async def home():
         </div>
     </body>
     </html>
-    """)
+    """).encode("utf-8")
+
+
+async def home(request: Request):
+    """Home page with instructions (static, rendered once at import)."""
+    return HTMLResponse(_HOME_HTML, headers={"Cache-Control": "public, max-age=3600"})
+
+
+# ============================================================================
+# Middleware
+# ============================================================================
+
+class ClientDisconnectMiddleware:
+    """Cancel the request handler as soon as the client disconnects.
+
+    Without this, a handler blocked on an upstream call (e.g. the token
+    exchange) keeps running after the client is gone, holding its socket
+    and pooled connection. Only a disconnect that arrives before the final
+    response body counts as an abort: servers also report http.disconnect
+    once the response is complete, and work after that point (e.g. background
+    tasks) must be left to finish. Streaming MCP paths (/mcp and /mcp/...)
+    are passed through untouched.
+    """
+
+    def __init__(self, app, skip_prefixes: tuple[str, ...] = ("/mcp/",)):
+        self.app = app
+        self.skip_prefixes = skip_prefixes
+
+    async def __call__(self, scope, receive, send):
+        # Append "/" so the bare "/mcp" matches too, but "/mcpfoo" does not
+        if scope["type"] != "http" or f"{scope['path']}/".startswith(self.skip_prefixes):
+            await self.app(scope, receive, send)
+            return
+
+        messages: asyncio.Queue = asyncio.Queue()
+        response_complete = False
+        disconnected = False
+
+        async def send_wrapper(message):
+            nonlocal response_complete
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                response_complete = True
+            await send(message)
+
+        handler = asyncio.create_task(self.app(scope, messages.get, send_wrapper))
+
+        async def watch_disconnect():
+            nonlocal disconnected
+            while True:
+                message = await receive()
+                await messages.put(message)
+                if message["type"] == "http.disconnect":
+                    if not response_complete:
+                        disconnected = True
+                        handler.cancel()
+                    return
+
+        watcher = asyncio.create_task(watch_disconnect())
+        try:
+            await handler
+        except asyncio.CancelledError:
+            if not disconnected:
+                raise
+        finally:
+            watcher.cancel()
 
 
 # ============================================================================
@@ -447,6 +732,7 @@ async def home():
 
 from starlette.routing import Route, Mount
 from starlette.applications import Starlette
+from starlette.middleware import Middleware
 
 # Get the MCP app
 mcp_app = mcp.http_app
@@ -462,9 +748,48 @@ routes = [
     Mount("", mcp_app),
 ]
 
+
+async def _sweep_expired(stores: list[TTLStore]):
+    """Periodically purge expired entries from in-memory stores."""
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL)
+        for store in stores:
+            store.purge_expired()
+
+
+@asynccontextmanager
+async def lifespan(app: Starlette):
+    """Run FastMCP's lifespan and release shared clients on shutdown."""
+    in_memory = [store for store in (tx_store, prefs_store) if isinstance(store, TTLStore)]
+    sweeper = asyncio.create_task(_sweep_expired(in_memory)) if in_memory else None
+    async with mcp_app.lifespan(app):
+        try:
+            yield
+        finally:
+            if sweeper is not None:
+                sweeper.cancel()
+            await close_http_client()
+            if redis_client is not None:
+                await redis_client.aclose()
+
+
+# Middleware is declared up front rather than added after startup. Any custom
+# middleware should be pure ASGI (async __call__(scope, receive, send)), not a
+# BaseHTTPMiddleware subclass, to avoid its per-request overhead.
+middleware = [
+    # Outermost, so a disconnect cancels everything below it
+    Middleware(ClientDisconnectMiddleware),
+    Middleware(
+        SessionMiddleware,
+        secret_key=SESSION_SECRET,
+        https_only=BASE_URL.startswith("https://"),
+        max_age=600,
+    ),
+]
+
 # Create Starlette app with proper route ordering
-# IMPORTANT: Pass the lifespan from mcp_app to Starlette for proper FastMCP initialization
-app = Starlette(routes=routes, lifespan=mcp_app.lifespan)
+# IMPORTANT: Wrap the lifespan from mcp_app for proper FastMCP initialization
+app = Starlette(routes=routes, middleware=middleware, lifespan=lifespan)
 
 
 # ============================================================================
@@ -480,7 +805,6 @@ def main():
         level=logging.INFO,
         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
     )
-    logger = logging.getLogger("server")
     
     timeout = get_shutdown_timeout()
     logger.info(f"Graceful shutdown timeout: {timeout}s")
@@ -495,18 +819,37 @@ def main():
     print(f"Graceful shutdown timeout: {timeout}s")
     print()
     
-    # Build uvicorn config with graceful shutdown timeout
+    # Build uvicorn config with graceful shutdown timeout. Reload is opt-in
+    # (RELOAD=1) since the reloader forks per change and is unsuitable for production.
     config = uvicorn.Config(
         "server:app",
         host="0.0.0.0",
         port=PORT,
         log_level="info",
+        loop="uvloop",
+        http="httptools",
+        lifespan="on",
+        workers=int(os.getenv("WORKERS", 1)),
         timeout_graceful_shutdown=timeout,
-        reload=True,
+        reload=bool(int(os.getenv("RELOAD", "0"))),
     )
     
     server = uvicorn.Server(config)
     
+    # In-memory stores are per process, so a login started on one worker
+    # would be "Invalid or expired" on another
+    if config.workers > 1 and not REDIS_URL:
+        raise ValueError("WORKERS > 1 requires REDIS_URL to be set in .env")
+    
+    # Server.run() ignores reload/workers; those need uvicorn's supervisors,
+    # which manage their own worker processes and signal handling.
+    if config.should_reload or config.workers > 1:
+        from uvicorn.supervisors import ChangeReload, Multiprocess
+        
+        supervisor = ChangeReload if config.should_reload else Multiprocess
+        supervisor(config, target=server.run, sockets=[config.bind_socket()]).run()
+        return
+    
     # Override signal handlers to add force-exit timer
     shutdown_started = threading.Event()
     force_timer: Optional[threading.Timer] = None
@@ -554,7 +897,8 @@ def main():
             except Exception:
                 server.should_exit = True
             
-            # Start the force-exit timer
+            # Start the force-exit timer. This must run on its own thread, not
+            # the event loop: it exists to kill the process when the loop is stuck.
             force_timer = threading.Timer(timeout, _force_exit)
             force_timer.daemon = True
             force_timer.start()